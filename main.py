@@ -1,129 +1,265 @@
 #!/usr/bin/env python3
-import csv
+import mmap
 import os
 import threading
-import time
 import tkinter as tk
-from concurrent.futures import ProcessPoolExecutor
-from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import closing
+from datetime import date, datetime, timedelta
 from functools import partial
 from pathlib import Path
 from tkinter import filedialog, messagebox, ttk
-from typing import Callable, TextIO
+from typing import BinaryIO, Callable, Iterator, Optional
 
+DEFAULT_DATE_FMT = "%m/%d/%Y"
+DEFAULT_TIME_FMT = "%H:%M"
+CHUNK_SIZE = 1024 * 1024
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+PARALLEL_MIN_BYTES = 128 * 1024 * 1024
+SEGMENT_SIZE = 32 * 1024 * 1024
+PROGRESS_INTERVAL_MS = 50
 
 
-def process_row(
-        row: list[str],
-        in_date_fmt: str,
-        in_time_fmt: str,
-        out_date_fmt: str,
-        out_time_fmt: str,
-) -> list[str]:
-    date_time = datetime.strptime(f"{row[0].strip()} {row[1].strip()}", f"{in_date_fmt} {in_time_fmt}")
-    date_time = date_time - timedelta(minutes=1)
+def shift_time(time_str: bytes, in_time_fmt: str, out_time_fmt: str) -> tuple[bytes, bool]:
+    parsed = datetime.strptime(time_str.strip().decode("utf-8"), in_time_fmt)
+    shifted = parsed - timedelta(minutes=1)
+
+    return shifted.strftime(out_time_fmt).encode("utf-8"), shifted.day != parsed.day
+
+
+def shift_date(date_str: bytes, previous: bool, in_date_fmt: str, out_date_fmt: str) -> bytes:
+    parsed = datetime.strptime(date_str.strip().decode("utf-8"), in_date_fmt)
+
+    if previous:
+        parsed = parsed - timedelta(days=1)
+
+    return parsed.strftime(out_date_fmt).encode("utf-8")
+
+
+def shift_hh_mm(time_str: bytes) -> tuple[bytes, bool]:
+    time_str = time_str.strip()
+
+    hours = time_str[0:2]
+    minutes = time_str[3:5]
+
+    if (len(time_str) != 5 or time_str[2:3] != b":" or not hours.isdigit() or not minutes.isdigit()
+            or int(hours) >= 24 or int(minutes) >= 60):
+        return shift_time(time_str, DEFAULT_TIME_FMT, DEFAULT_TIME_FMT)
+
+    minutes = int(hours) * 60 + int(minutes) - 1
+
+    if minutes < 0:
+        return b"23:59", True
+
+    return b"%02d:%02d" % (minutes // 60, minutes % 60), False
+
+
+def shift_mm_dd_yyyy(date_str: bytes, previous: bool) -> bytes:
+    date_str = date_str.strip()
 
-    row[0] = date_time.strftime(out_date_fmt)
-    row[1] = date_time.strftime(out_time_fmt)
+    if (len(date_str) != 10 or date_str[2:3] != b"/" or date_str[5:6] != b"/"
+            or not date_str.replace(b"/", b"").isdigit()):
+        return shift_date(date_str, previous, DEFAULT_DATE_FMT, DEFAULT_DATE_FMT)
 
-    return row
+    day = date(int(date_str[6:10]), int(date_str[0:2]), int(date_str[3:5]))
 
+    if not previous:
+        return date_str
 
-def autotune(
-        input_file: TextIO,
-        reader,
+    day = date.fromordinal(day.toordinal() - 1)
+
+    return b"%02d/%02d/%04d" % (day.month, day.day, day.year)
+
+
+TIME_SHIFTERS: dict[tuple[str, str], Callable[[bytes], tuple[bytes, bool]]] = {
+    (DEFAULT_TIME_FMT, DEFAULT_TIME_FMT): shift_hh_mm,
+}
+DATE_SHIFTERS: dict[tuple[str, str], Callable[[bytes, bool], bytes]] = {
+    (DEFAULT_DATE_FMT, DEFAULT_DATE_FMT): shift_mm_dd_yyyy,
+}
+
+
+def make_line_processor(
         in_date_fmt: str,
         in_time_fmt: str,
         out_date_fmt: str,
         out_time_fmt: str,
-        workers: int
-):
-    prefetch_out = []
+) -> Callable[[list[bytes]], bytearray]:
+    times: dict[bytes, tuple[bytes, bool]] = {}
+    dates: dict[bytes, bytes] = {}
+    previous_dates: dict[bytes, bytes] = {}
+    time_shifter = (TIME_SHIFTERS.get((in_time_fmt, out_time_fmt))
+                    or partial(shift_time, in_time_fmt=in_time_fmt, out_time_fmt=out_time_fmt))
+    date_shifter = (DATE_SHIFTERS.get((in_date_fmt, out_date_fmt))
+                    or partial(shift_date, in_date_fmt=in_date_fmt, out_date_fmt=out_date_fmt))
 
-    initial_time = time.perf_counter()
-    initial_pos = input_file.buffer.tell()
+    def process_lines(lines: list[bytes]) -> bytearray:
+        out = bytearray()
 
-    for i in range(5000):
-        row = next(reader)
-        prefetch_out.append(process_row(row, in_date_fmt, in_time_fmt, out_date_fmt, out_time_fmt))
+        for line in lines:
+            fields = line.split(b",", 2)
+            ending = b""
 
-    final_pos = input_file.buffer.tell()
-    total_time = time.perf_counter() - initial_time
-    bytes_read = final_pos - initial_pos
-    bytes_per_row = bytes_read / len(prefetch_out)
-    rows_per_second = len(prefetch_out) / total_time
+            if len(fields) < 3:
+                if not line.strip():
+                    out += line
+                    continue
 
-    chunk_rows = max(500, min(20000, int(rows_per_second * 0.10)))
-    mem_limit_bytes = 64 * 1024 * 1024
-    batch_by_formula = chunk_rows * max(1, workers) * 4
-    batch_by_mem = max(5000, min(200000, int(mem_limit_bytes / bytes_per_row)))
-    batch_rows = max(chunk_rows, min(batch_by_formula, batch_by_mem))
+                if len(fields) < 2:
+                    raise ValueError(f"Invalid row: {line!r}")
 
-    return prefetch_out, chunk_rows, batch_rows
+                time_str = fields[1].rstrip(b"\r\n")
+                ending = fields[1][len(time_str):]
+                fields[1] = time_str
 
+            shifted = times.get(fields[1])
 
-def convert_csv_minus_one_minute(
-        input_path: str,
-        progress_callback: Callable[[float], None],
-        in_date_fmt: str = "%m/%d/%Y",
-        in_time_fmt: str = "%H:%M",
-        out_date_fmt: str = "%m/%d/%Y",
-        out_time_fmt: str = "%H:%M",
-) -> str:
-    source_path = Path(input_path)
-    result_path = source_path.with_name(source_path.stem + "_MT" + source_path.suffix)
-    total_bytes = os.path.getsize(source_path)
-    workers = os.cpu_count()
+            if shifted is None:
+                shifted = times[fields[1]] = time_shifter(fields[1])
+
+            fields[1], previous = shifted
+            table = previous_dates if previous else dates
+            date_str = table.get(fields[0])
 
-    if not source_path.exists():
-        raise FileNotFoundError(f"File not exist.: {source_path}")
+            if date_str is None:
+                date_str = table[fields[0]] = date_shifter(fields[0], previous)
 
-    with (open(source_path, "r", encoding="utf-8", newline="") as input_file,
-          open(result_path, "w", encoding="utf-8", newline="") as result_file):
-        reader = csv.reader(input_file)
-        writer = csv.writer(result_file)
+            fields[0] = date_str
 
-        header = next(reader)
-        writer.writerow(header)
+            out += b",".join(fields)
+            out += ending
 
-        prefetch_out, chunk_size, batch_rows = autotune(
-            input_file,
-            reader,
-            in_date_fmt,
-            in_time_fmt,
-            out_date_fmt,
-            out_time_fmt,
-            workers
-        )
+        return out
 
-        for row in prefetch_out:
-            writer.writerow(row)
+    return process_lines
 
-        last_pos = input_file.buffer.tell()
 
-        progress_callback(last_pos / total_bytes * 100)
+worker_process_lines: Optional[Callable[[list[bytes]], bytearray]] = None
 
-        process = partial(process_row, in_date_fmt=in_date_fmt,
-                          in_time_fmt=in_time_fmt,
-                          out_date_fmt=out_date_fmt,
-                          out_time_fmt=out_time_fmt)
 
-        with ProcessPoolExecutor(max_workers=workers) as process_pool:
-            batch = []
+def init_worker(in_date_fmt: str, in_time_fmt: str, out_date_fmt: str, out_time_fmt: str):
+    global worker_process_lines
+    worker_process_lines = make_line_processor(in_date_fmt, in_time_fmt, out_date_fmt, out_time_fmt)
 
-            for row in reader:
-                batch.append(row)
 
-                if len(batch) >= batch_rows:
-                    for new_row in process_pool.map(process, batch, chunksize=chunk_size):
-                        writer.writerow(new_row)
-                    batch.clear()
-                    progress_callback(input_file.buffer.tell() / total_bytes * 100)
+def advise_sequential(input_file: BinaryIO, source: mmap.mmap):
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(input_file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
 
-            if batch:
-                for new_row in process_pool.map(process, batch, chunksize=chunk_size):
-                    writer.writerow(new_row)
-                progress_callback(input_file.buffer.tell() / total_bytes * 100)
+    if hasattr(mmap, "MADV_SEQUENTIAL"):
+        source.madvise(mmap.MADV_SEQUENTIAL)
+
+
+def iter_windows(source: mmap.mmap, start: int, stop: int) -> Iterator[tuple[int, int]]:
+    while start < stop:
+        end = source.find(b"\n", min(start + CHUNK_SIZE, stop) - 1, stop) + 1 or stop
+        yield start, end
+        start = end
+
+
+def split_segments(source: mmap.mmap, start: int, count: int) -> list[tuple[int, int]]:
+    size = len(source)
+    step = max(1, (size - start) // count)
+    bounds = [start]
+
+    for index in range(1, count):
+        bound = source.find(b"\n", start + index * step) + 1 or size
+
+        if bounds[-1] < bound < size:
+            bounds.append(bound)
+
+    bounds.append(size)
+
+    return list(zip(bounds, bounds[1:]))
+
+
+def convert_segment(path: str, start: int, stop: int, segment_path: str):
+    with (open(path, "rb") as input_file,
+          mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as source,
+          open(segment_path, "wb", buffering=WRITE_BUFFER_SIZE) as segment_file):
+        advise_sequential(input_file, source)
+
+        for window_start, window_end in iter_windows(source, start, stop):
+            segment_file.write(worker_process_lines(source[window_start:window_end].splitlines(keepends=True)))
+
+
+def convert_segments_in_parallel(
+        path: str,
+        result_path: Path,
+        segments: list[tuple[int, int]],
+        workers: int,
+        formats: tuple[str, str, str, str],
+) -> Iterator[tuple[int, bytes]]:
+    segment_paths = [result_path.with_name(f"{result_path.name}.part{index}") for index in range(len(segments))]
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=formats) as process_pool:
+            futures = [process_pool.submit(convert_segment, path, start, stop, str(segment_path))
+                       for (start, stop), segment_path in zip(segments, segment_paths)]
+
+            try:
+                for (start, stop), segment_path, future in zip(segments, segment_paths, futures):
+                    future.result()
+
+                    with open(segment_path, "rb") as segment_file:
+                        while chunk := segment_file.read(WRITE_BUFFER_SIZE):
+                            yield stop, chunk
+
+                    segment_path.unlink()
+            finally:
+                for future in futures:
+                    future.cancel()
+    finally:
+        for segment_path in segment_paths:
+            segment_path.unlink(missing_ok=True)
+
+
+def convert_csv_minus_one_minute(
+        input_path: str,
+        progress_callback: Callable[[float], None],
+        in_date_fmt: str = "%m/%d/%Y",
+        in_time_fmt: str = "%H:%M",
+        out_date_fmt: str = "%m/%d/%Y",
+        out_time_fmt: str = "%H:%M",
+) -> str:
+    source_path = Path(input_path)
+    result_path = source_path.with_name(source_path.stem + "_MT" + source_path.suffix)
+
+    with open(source_path, "rb", buffering=0) as input_file:
+        if os.fstat(input_file.fileno()).st_size == 0:
+            result_path.write_bytes(b"")
+            return str(result_path)
+
+        with (mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as source,
+              open(result_path, "wb", buffering=WRITE_BUFFER_SIZE) as result_file,
+              ThreadPoolExecutor(max_workers=1, thread_name_prefix="write-thread") as write_pool):
+            advise_sequential(input_file, source)
+            size = len(source)
+            start = source.find(b"\n") + 1 or size
+            written = write_pool.submit(result_file.write, source[:start])
+
+            formats = (in_date_fmt, in_time_fmt, out_date_fmt, out_time_fmt)
+            workers = os.cpu_count() or 1
+            reported = -1
+
+            if workers > 1 and size >= PARALLEL_MIN_BYTES:
+                segments = split_segments(source, start, max(workers * 4, size // SEGMENT_SIZE))
+                converted = convert_segments_in_parallel(str(source_path), result_path, segments, workers, formats)
+            else:
+                process = make_line_processor(*formats)
+                converted = ((window_end, process(source[window_start:window_end].splitlines(keepends=True)))
+                             for window_start, window_end in iter_windows(source, start, size))
+
+            with closing(converted):
+                for end, chunk in converted:
+                    written.result()
+                    written = write_pool.submit(result_file.write, chunk)
+
+                    if end * 100 // size != reported:
+                        reported = end * 100 // size
+                        progress_callback(end / size * 100)
+
+            written.result()
 
     return str(result_path)
 
@@ -220,12 +356,27 @@ def build_ui():
     btn.grid(row=4, column=0, columnspan=3, pady=8)
     btn.focus_set()
 
-    def on_progress(percent: int):
-        root.after(0, lambda p=percent: pb.configure(value=p))
+    last_percent = 0.0
+    progress_pending = False
+
+    def flush_progress():
+        nonlocal progress_pending
+        progress_pending = False
+        pb.configure(value=last_percent)
+
+    def on_progress(percent: float):
+        nonlocal last_percent, progress_pending
+        last_percent = percent
+
+        if not progress_pending:
+            progress_pending = True
+            root.after(PROGRESS_INTERVAL_MS, flush_progress)
 
     def on_complete():
+        nonlocal last_percent
         root.after(0)
         btn.config(state="normal")
+        last_percent = 100.0
         pb.configure(value=100.0)
         messagebox.showinfo("Success!", f"Conversion finished: \n")
 